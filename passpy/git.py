@@ -67,7 +67,9 @@ def git_add_path(repo, path, msg, commit=True, verbose=False):
     :type repo: :class:`git.repo.base.Repo`
 
     :param path: The path of the file or directory to commit relative
-        to :py:attr:`passpy.store.Store.store_dir`.
+        to :py:attr:`passpy.store.Store.store_dir`.  If the list is
+        empty, only the changes that are already staged will be
+        commited.
     :type path: str or list
 
     :param str msg: The commit message.
@@ -85,7 +87,8 @@ def git_add_path(repo, path, msg, commit=True, verbose=False):
         return
     if not isinstance(path, list):
         path = [path]
-    repo.git.add(*path)
+    if path:
+        repo.git.add(*path)
     if commit:
         _git_commit(repo, msg, verbose)
 
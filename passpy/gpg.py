@@ -16,9 +16,38 @@
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 from gnupg import GPG
 
 
+# One gpg object per gpg binary and options, see _get_gpg.
+_GPG_CACHE = {}
+
+
+def _get_gpg(gpg_bin, gpg_opts):
+    """Get a gpg object for the given binary and options.
+
+    Creating a :class:`gnupg.GPG` object runs the gpg binary to
+    determine its version, so the objects are created only once and
+    then reused for every following call.
+
+    :param str gpg_bin: The path to the gpg binary.
+
+    :param list gpg_opts: The options for gpg.
+
+    :rtype: :class:`gnupg.GPG`
+    :returns: The gpg object for `gpg_bin` and `gpg_opts`.
+
+    """
+    cache_key = (gpg_bin, tuple(gpg_opts))
+    gpg = _GPG_CACHE.get(cache_key)
+    if gpg is None:
+        gpg = GPG(gpgbinary=gpg_bin, options=gpg_opts)
+        _GPG_CACHE[cache_key] = gpg
+    return gpg
+
+
 def _get_gpg_recipients(path):
     """Get the GPG recipients for the given path.
 
@@ -35,18 +64,41 @@ def _get_gpg_recipients(path):
     while True:
         gpg_id_path = os.path.join(path, '.gpg-id')
         if os.path.isfile(gpg_id_path):
-            break;
-        path = os.path.dirname(path)
-
-    if path is None or path == '':
-        raise FileNotFoundError(
-                'You must initialise the password store first!')
+            break
+        parent = os.path.dirname(path)
+        # We reached the root (or the start of a relative path)
+        # without finding a gpg id.
+        if parent == path:
+            raise FileNotFoundError(
+                    'You must initialise the password store first!')
+        path = parent
 
     with open(gpg_id_path) as gpg_id_file:
         gpg_recipients = [line.rstrip('\n') for line in gpg_id_file]
     return gpg_recipients
 
 
+def read_key_status(path, gpg_bin, gpg_opts):
+    """Read and decrypt a single key file and report success.
+
+    :param str path: The path to the key to decrypt.
+
+    :param str gpg_bin: The path to the gpg binary.
+
+    :param list gpg_opts: The options for gpg.
+
+    :rtype: (str, bool)
+    :returns: The unencrypted content of the file at `path` and
+        whether gpg could decrypt it.  The content is empty if
+        decrypting failed.
+
+    """
+    gpg = _get_gpg(gpg_bin, gpg_opts)
+    with open(path, 'rb') as key_file:
+        result = gpg.decrypt_file(key_file)
+    return str(result), result.ok
+
+
 def read_key(path, gpg_bin, gpg_opts):
     """Read and decrypt a single key file.
 
@@ -60,9 +112,7 @@ def read_key(path, gpg_bin, gpg_opts):
     :returns: The unencrypted content of the file at `path`.
 
     """
-    gpg = GPG(gpgbinary=gpg_bin, options=gpg_opts)
-    with open(path, 'rb') as key_file:
-        return str(gpg.decrypt_file(key_file))
+    return read_key_status(path, gpg_bin, gpg_opts)[0]
 
 
 def write_key(path, key_data, gpg_bin, gpg_opts):
@@ -75,7 +125,7 @@ def write_key(path, key_data, gpg_bin, gpg_opts):
     :param list gpg_opts: The options for gpg.
 
     """
-    gpg = GPG(gpgbinary=gpg_bin, options=gpg_opts)
+    gpg = _get_gpg(gpg_bin, gpg_opts)
     gpg_recipients = _get_gpg_recipients(path)
     # pass always ends it's files with an endline
     if not key_data.endswith('\n'):
@@ -98,19 +148,30 @@ def _reencrypt_key(path, gpg, gpg_recipients):
     :param list gpg_recipients: The list of GPG Ids to encrypt the key
         with.
 
+    :raises OSError: if the key could not be decrypted or encrypted.
+        The key file is left untouched in that case.
+
     """
     with open(path, 'rb') as key_file:
-        key_data = gpg.decrypt_file(key_file).data
-    key_data_enc = gpg.encrypt(key_data, gpg_recipients).data
+        decrypted = gpg.decrypt_file(key_file)
+    # Never replace a key with the encryption of an empty string.
+    if not decrypted.ok:
+        raise OSError('Could not decrypt {0}: {1}'
+                      .format(path, decrypted.status))
+    encrypted = gpg.encrypt(decrypted.data, gpg_recipients)
+    if not encrypted.ok:
+        raise OSError('Could not encrypt {0}: {1}'
+                      .format(path, encrypted.status))
     with open(path, 'wb') as key_file:
-        key_file.write(key_data_enc)
+        key_file.write(encrypted.data)
 
 
-def reencrypt_path(path, gpg_bin, gpg_opts):
+def reencrypt_path(path, gpg_bin, gpg_opts, max_workers=None):
     """Reencrypt a single or multiple keys.
 
     If path is a directory all keys inside that directory and it's
-    subdirectories will be reencrypted.
+    subdirectories will be reencrypted.  As every key is handled by
+    its own gpg processes, the keys are reencrypted in parallel.
 
     :param str path: The key or directory to reencrypt.  If ``None``
         the function will silently fail.
@@ -119,22 +180,49 @@ def reencrypt_path(path, gpg_bin, gpg_opts):
 
     :param list gpg_opts: The gpg options.
 
+    :param int max_workers: (optional) The maximum number of keys to
+        reencrypt at the same time.  Defaults to the number of
+        processors on the machine.
+
     :raises FileNotFoundError: if path does not exist.
 
+    :rtype: list
+    :returns: The paths of all reencrypted keys.
+
     """
     if path is None:
-        return
-    gpg = GPG(gpgbinary=gpg_bin, options=gpg_opts)
+        return []
+    gpg = _get_gpg(gpg_bin, gpg_opts)
     if os.path.isfile(path):
         gpg_recipients = _get_gpg_recipients(path)
         _reencrypt_key(path, gpg, gpg_recipients)
-    elif os.path.isdir(path):
-        for root, dirs, keys in os.walk(path):
-            gpg_recipients = _get_gpg_recipients(root)
-            for key in keys:
-                if not key.endswith('.gpg'):
-                    continue
-                key_path = os.path.join(root, key)
-                _reencrypt_key(key_path, gpg, gpg_recipients)
-    else:
+        return [path]
+    elif not os.path.isdir(path):
         raise FileNotFoundError('{0} does not exist.'.format(path))
+
+    key_paths = []
+    key_recipients = []
+    for root, dirs, keys in os.walk(path):
+        gpg_recipients = _get_gpg_recipients(root)
+        for key in keys:
+            if not key.endswith('.gpg'):
+                continue
+            key_paths.append(os.path.join(root, key))
+            key_recipients.append(gpg_recipients)
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_reencrypt_key, key_path, gpg,
+                                   gpg_recipients)
+                   for key_path, gpg_recipients
+                   in zip(key_paths, key_recipients)]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            # Don't start on any more keys once one has failed.
+            for future in futures:
+                future.cancel()
+            raise
+    return key_paths
@@ -14,9 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>._
 
+import functools
 import os
 import re
 import shutil
+import stat
+import threading
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 from passpy.git import (
     get_git_repository,
@@ -29,6 +40,7 @@ from passpy.git import (
 from passpy.gpg import (
     reencrypt_path,
     read_key,
+    read_key_status,
     write_key
 )
 
@@ -40,6 +52,65 @@ from passpy.util import (
 )
 
 
+# The maximum number of decrypted keys a store keeps in memory.
+KEY_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=128)
+def _compile(term, flags=0):
+    """Compile a regular expression and cache the result.
+
+    :param str term: The regular expression.
+
+    :param int flags: (optional) The flags for :func:`re.compile`.
+
+    :rtype: :class:`re.Pattern`
+    :returns: The compiled regular expression.
+
+    """
+    return re.compile(term, flags)
+
+
+def _stat(path):
+    """Get the status of a path without raising an error.
+
+    Lets the callers distinguish directories, files and missing
+    entries with a single system call.
+
+    :param str path: The path to get the status for.
+
+    :rtype: :class:`os.stat_result`
+    :returns: The status of `path` or ``None`` if `path` cannot be
+        accessed.
+
+    """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# Marks lazily computed attributes that have not been computed yet.
+_UNSET = object()
+
+
+def _entry_sort_key(entry):
+    """Sort key for :class:`os.DirEntry` objects.
+
+    The entries of a directory are listed in case insensitive
+    lexicographical order of their names.
+
+    """
+    return entry.name.lower()
+
+
+# Matches the parts of a regular expression that look at the start or
+# end of the whole string or at the text around a match, or that turn
+# off re.MULTILINE for a group, like `(?-m:^foo)`.  These give
+# different results on a single line than on a whole key.
+_CONTEXT_TERM = re.compile(r'\\[AZz]|\(\?<?[=!]|\(\?[a-zA-Z]*-[a-zA-Z]*m')
+
+
 class Store():
     """Python implementation of ZX2C4's password store.
     """
@@ -78,9 +149,21 @@ class Store():
                          '--no-encrypt-to']
         if use_agent:
             self.gpg_opts += ['--batch', '--use-agent']
+        # Without an agent gpg asks for the passphrase of every key
+        # on its own, so we may only run one gpg process at a time.
+        self.gpg_workers = os.cpu_count() if use_agent else 1
 
         self.store_dir = os.path.normpath(os.path.expanduser(store_dir))
-        self.repo = get_git_repository(self.store_dir)
+        # Absolute paths in the store start with the store directory
+        # followed by a separator.
+        self._store_prefix_len = len(os.path.join(self.store_dir, ''))
+        # Looking up the git repository is deferred until it is
+        # actually needed, see :attr:`passpy.store.Store.repo`.
+        self._repo = _UNSET
+        # Maps the path of a key file to its modification time, size
+        # and decrypted content.
+        self._key_cache = OrderedDict()
+        self._key_cache_lock = threading.Lock()
 
         self.interactive = interactive
         self.verbose = verbose
@@ -88,6 +171,24 @@ class Store():
     def __iter__(self):
         return self.iter_dir('')
 
+    @property
+    def repo(self):
+        """The git repository of the password store.
+
+        Looked up on first access and ``None`` if the store is not a
+        git repository.
+
+        :rtype: :class:`git.repo.base.Repo`
+
+        """
+        if self._repo is _UNSET:
+            self._repo = get_git_repository(self.store_dir)
+        return self._repo
+
+    @repo.setter
+    def repo(self, repo):
+        self._repo = repo
+
     def _get_store_name(self, path):
         """Returns the path relative to the store.
 
@@ -99,12 +200,61 @@ class Store():
             and trailing '.gpg' if any.
 
         """
-        path = os.path.relpath(path, self.store_dir)
+        assert path.startswith(os.path.join(self.store_dir, ''))
+        path = path[self._store_prefix_len:]
         # Keys are identified without their file ending.
         if path.endswith('.gpg'):
             path = path[:-4]
         return path
 
+    def _read_key_cached(self, key_path, key_stat):
+        """Read and decrypt a key file, reusing earlier results.
+
+        A cached key is only returned as long as the modification time
+        and size of its file did not change since it got decrypted.
+
+        :param str key_path: The absolute path to the key file.
+
+        :param key_stat: The result of :func:`os.stat` for `key_path`.
+        :type key_stat: :class:`os.stat_result`
+
+        :rtype: str
+        :returns: The unencrypted content of the file at `key_path`.
+
+        """
+        stamp = (key_stat.st_mtime_ns, key_stat.st_size)
+        with self._key_cache_lock:
+            entry = self._key_cache.get(key_path)
+            if entry is not None and entry[0] == stamp:
+                self._key_cache.move_to_end(key_path)
+                return entry[1]
+
+        key_data, ok = read_key_status(key_path, self.gpg_bin,
+                                       self.gpg_opts)
+        # Don't remember failures, e.g. a cancelled pinentry, so the
+        # next access tries to decrypt the key again.
+        if not ok:
+            return key_data
+        with self._key_cache_lock:
+            self._key_cache[key_path] = (stamp, key_data)
+            self._key_cache.move_to_end(key_path)
+            if len(self._key_cache) > KEY_CACHE_SIZE:
+                self._key_cache.popitem(last=False)
+        return key_data
+
+    def _uncache_path(self, path):
+        """Remove a key or all keys in a directory from the key cache.
+
+        :param str path: The absolute path to a key file or directory.
+
+        """
+        prefix = os.path.join(path, '')
+        with self._key_cache_lock:
+            for key_path in [key_path for key_path in self._key_cache
+                             if key_path == path
+                             or key_path.startswith(prefix)]:
+                del self._key_cache[key_path]
+
     def is_init(self):
         gpg_id_path = os.path.join(self.store_dir, '.gpg-id')
         if os.path.isfile(gpg_id_path):
@@ -142,14 +292,15 @@ class Store():
         else:
             path = os.path.normpath(os.path.join(self.store_dir, path))
 
-        if os.path.exists(path):
-            if not os.path.isdir(path):
-                raise FileExistsError('{0} exists but is not a directory.'.format(path))
+        path_stat = _stat(path)
+        if path_stat is not None and not stat.S_ISDIR(path_stat.st_mode):
+            raise FileExistsError('{0} exists but is not a directory.'.format(path))
 
         # Ensure that gpg_ids is a list so that the later .join does
         # not accidentally join single letters of a string.
         if gpg_ids is not None and not isinstance(gpg_ids, list):
             gpg_ids = [gpg_ids]
+        gpg_ids_str = ', '.join(gpg_ids or [])
 
         gpg_id_path = os.path.join(path, '.gpg-id')
 
@@ -160,28 +311,63 @@ class Store():
                                          'cannot be removed.')
                                         .format(gpg_id_path))
             os.remove(gpg_id_path)
-            git_remove_path(self.repo, [gpg_id_path],
-                            'Deinitialize {0}.'.format(gpg_id_path),
-                            recursive=True, verbose=self.verbose)
+            git_remove_path(self.repo, [gpg_id_path], '', recursive=True,
+                            commit=False)
+            git_paths = []
+            msg = 'Deinitialize {0}.'.format(gpg_id_path)
+            # The keys can only be reencrypted if a parent directory in
+            # the store still has a gpg id.
+            reencrypt = False
+            parent_dir = path
+            while parent_dir != self.store_dir:
+                next_dir = os.path.dirname(parent_dir)
+                if next_dir == parent_dir:
+                    break
+                parent_dir = next_dir
+                if os.path.isfile(os.path.join(parent_dir, '.gpg-id')):
+                    reencrypt = True
+                    break
             # The password store should not contain any empty directories,
-            # so we try to remove as many directories as we can.  Any
-            # nonempty ones will throw an error and will not be
-            # removed.
-            shutil.rmtree(path, ignore_errors=True)
+            # so we try to remove as many directories as we can, like
+            # os.removedirs but without leaving the store.  The first
+            # nonempty one will throw an error and stop the removal.
+            rm_dir = path
+            while True:
+                try:
+                    os.rmdir(rm_dir)
+                except OSError:
+                    break
+                if rm_dir == self.store_dir:
+                    break
+                rm_dir = os.path.dirname(rm_dir)
         else:
-            os.makedirs(path)
+            if path_stat is None:
+                os.makedirs(path)
             # pass needs the gpg id file to be newline terminated.
             with open(gpg_id_path, 'w') as gpg_id_file:
                 gpg_id_file.write('\n'.join(gpg_ids))
                 gpg_id_file.write('\n')
-            git_add_path(self.repo, gpg_id_path, 'Set GPG id to {0}.'
-                         .format(', '.join(gpg_ids)), verbose=self.verbose)
-
-        reencrypt_path(path, gpg_bin=self.gpg_bin,
-                       gpg_opts=self.gpg_opts)
-        git_add_path(self.repo, path,
-                     'Reencrypt password store using new GPG id {0}.'
-                     .format(', '.join(gpg_ids)), verbose=self.verbose)
+            git_paths = [gpg_id_path]
+            msg = 'Set GPG id to {0}.'.format(gpg_ids_str)
+            reencrypt = True
+
+        self._uncache_path(path)
+        key_paths = []
+        # path is gone if it was an empty directory that got
+        # deinitialised.
+        if reencrypt and os.path.isdir(path):
+            key_paths = reencrypt_path(path, gpg_bin=self.gpg_bin,
+                                       gpg_opts=self.gpg_opts,
+                                       max_workers=self.gpg_workers)
+        if key_paths:
+            # Add the directory instead of every single key, which
+            # could exceed the maximum command line length.
+            git_paths.append(path)
+            if gpg_ids:
+                msg = ('Reencrypt password store using new GPG id {0}.'
+                       .format(gpg_ids_str))
+        # Commit the changed gpg id and all reencrypted keys at once.
+        git_add_path(self.repo, git_paths, msg, verbose=self.verbose)
 
     @initialised
     def init_git(self):
@@ -236,8 +422,9 @@ class Store():
         path = os.path.normpath(path)
 
         key_path = os.path.join(self.store_dir, path + '.gpg')
-        if os.path.isfile(key_path):
-            return read_key(key_path, self.gpg_bin, self.gpg_opts)
+        key_stat = _stat(key_path)
+        if key_stat is not None and stat.S_ISREG(key_stat.st_mode):
+            return self._read_key_cached(key_path, key_stat)
         raise FileNotFoundError('{0} is not in the password store.'
                                 .format(path))
 
@@ -267,7 +454,10 @@ class Store():
             raise FileExistsError('An entry already exists for {0}.'
                                   .format(path))
 
-        os.makedirs(os.path.join(self.store_dir, key_dir), exist_ok=True)
+        # Top level keys are stored directly in the store directory.
+        if key_dir != self.store_dir:
+            os.makedirs(key_dir, exist_ok=True)
+        self._uncache_path(key_path)
         write_key(key_path, key_data, self.gpg_bin, self.gpg_opts)
 
         git_add_path(self.repo, key_path,
@@ -292,7 +482,8 @@ class Store():
         """
         key_path = os.path.join(self.store_dir, path)
         key_path = os.path.normpath(key_path)
-        if os.path.isdir(key_path):
+        key_stat = _stat(key_path)
+        if key_stat is not None and stat.S_ISDIR(key_stat.st_mode):
             if self.interactive and not force:
                 answer = input('Really delete {0}? [y/N] '.format(path))
                 if answer.lower() != 'y':
@@ -303,7 +494,8 @@ class Store():
                 os.rmdir(key_path)
         else:
             key_path += '.gpg'
-            if not os.path.isfile(key_path):
+            key_stat = _stat(key_path)
+            if key_stat is None or not stat.S_ISREG(key_stat.st_mode):
                 raise FileNotFoundError('{0} is not in the password store.'
                                         .format(path))
             if self.interactive and not force:
@@ -312,13 +504,13 @@ class Store():
                     return
             os.remove(key_path)
 
+        self._uncache_path(key_path)
         if self.verbose:
             print('removed {0}'.format(path))
 
-        if not os.path.exists(key_path):
-            git_remove_path(self.repo, key_path,
-                            'Remove {0} from store.'.format(path),
-                            recursive=recursive, verbose=self.verbose)
+        git_remove_path(self.repo, key_path,
+                        'Remove {0} from store.'.format(path),
+                        recursive=recursive, verbose=self.verbose)
 
     @initialised
     @trap(1)
@@ -356,8 +548,11 @@ class Store():
                 raise FileExistsError('An entry already exists for {0}.'
                                       .format(path))
 
-        os.makedirs(os.path.join(self.store_dir, key_dir), exist_ok=True)
+        # Top level keys are stored directly in the store directory.
+        if key_dir != self.store_dir:
+            os.makedirs(key_dir, exist_ok=True)
 
+        self._uncache_path(key_path)
         password = gen_password(length, symbols=symbols)
         action = 'Add'
         if not inplace:
@@ -403,7 +598,8 @@ class Store():
         old_path_full = os.path.join(self.store_dir, old_path)
         new_path_full = os.path.join(self.store_dir, new_path)
 
-        if not os.path.isdir(old_path_full):
+        old_is_dir = os.path.isdir(old_path_full)
+        if not old_is_dir:
             old_path_full += '.gpg'
             if not (os.path.isdir(new_path_full)
                     or new_path_full.endswith('/')):
@@ -414,15 +610,22 @@ class Store():
                                   self.verbose)
         if new_path_full is None:
             return
+        self._uncache_path(new_path_full)
+        if move:
+            self._uncache_path(old_path_full)
 
-        if os.path.exists(new_path_full):
-            reencrypt_path(new_path_full, gpg_bin=self.gpg_bin,
-                           gpg_opts=self.gpg_opts)
+        # copy_move only returns paths it has just written to.
+        reencrypt_path(new_path_full, gpg_bin=self.gpg_bin,
+                       gpg_opts=self.gpg_opts,
+                       max_workers=self.gpg_workers)
 
         action = 'Copy'
         if move:
             action = 'Rename'
-            shutil.rmtree(old_path_full, ignore_errors=True)
+            # Keys are moved one by one, which leaves the directories
+            # they were in behind.
+            if old_is_dir:
+                shutil.rmtree(old_path_full, ignore_errors=True)
             if not os.path.exists(old_path_full):
                 git_remove_path(self.repo, old_path_full, '',
                                 recursive=True, commit=False)
@@ -479,7 +682,7 @@ class Store():
 
         """
         path = os.path.normpath(path)
-        path_dir = os.path.join(self.store_dir, path)
+        path_dir = os.path.normpath(os.path.join(self.store_dir, path))
         if path is None or not os.path.isdir(path_dir):
             raise FileNotFoundError('{0} is not a directory in the '
                                     'password store.'.format(path))
@@ -488,15 +691,14 @@ class Store():
         keys = []
 
         # We want to return the entries alphabetically sorted.
-        for entry in sorted(os.listdir(path_dir), key=str.lower):
-            if entry.startswith('.'):
+        for entry in sorted(os.scandir(path_dir), key=_entry_sort_key):
+            if entry.name.startswith('.'):
                 continue
-            entry_path = os.path.join(path_dir, entry)
-            if os.path.isdir(entry_path):
-                dirs.append(self._get_store_name(entry_path))
-            elif os.path.isfile(entry_path) and entry.endswith('.gpg'):
+            if entry.is_dir():
+                dirs.append(self._get_store_name(entry.path))
+            elif entry.is_file() and entry.name.endswith('.gpg'):
                 # Keys are named without their ending.
-                keys.append(self._get_store_name(entry_path))
+                keys.append(self._get_store_name(entry.path))
 
         return dirs, keys
 
@@ -504,28 +706,33 @@ class Store():
     @trap(1)
     def iter_dir(self, path):
         path = os.path.normpath(path)
-        path_dir = os.path.join(self.store_dir, path)
+        path_dir = os.path.normpath(os.path.join(self.store_dir, path))
         if path is None or not os.path.isdir(path_dir):
             raise FileNotFoundError('{0} is not a directory in the '
                                     'password store.'.format(path))
 
-        # List keys in lexicographical order.
-        entries = sorted(os.listdir(path_dir), key=str.lower)
-        for entry in entries:
+        # Walk the tree depth first with a stack of the open
+        # directories instead of recursing, so only `path` has to be
+        # checked and normalised.  List keys in lexicographical order.
+        stack = [iter(sorted(os.scandir(path_dir), key=_entry_sort_key))]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
             # Ignore hidden files and directories as pass does the same.
-            if entry.startswith('.'):
+            if entry.name.startswith('.'):
                 continue
-            entry_path = os.path.join(path_dir, entry)
-            entry_path_rel = os.path.relpath(entry_path, self.store_dir)
-            if os.path.isdir(entry_path):
-                yield from self.iter_dir(entry_path_rel)
+            if entry.is_dir():
+                stack.append(iter(sorted(os.scandir(entry.path),
+                                         key=_entry_sort_key)))
             # pass also shows files that do not end on .gpg in
             # it's overview, but will throw an error if trying to
             # access these files.  As this would make it harder to
             # automatically iterate over the keys in the store, we
             # just show files, that (probably) are in the store.
-            elif entry.endswith('.gpg'):
-                yield entry_path_rel[:-4]
+            elif entry.name.endswith('.gpg'):
+                yield entry.path[self._store_prefix_len:-4]
 
     @initialised
     def find(self, names):
@@ -546,8 +753,23 @@ class Store():
             return []
         if not isinstance(names, list):
             names = [names]
+        if not names:
+            return []
 
         keys = []
+        # With pyahocorasick installed all names are matched in a
+        # single pass over each key.  The automaton can't hold an
+        # empty name, which would match every key anyway.
+        if ahocorasick is not None and '' not in names:
+            automaton = ahocorasick.Automaton()
+            for name in names:
+                automaton.add_word(name, name)
+            automaton.make_automaton()
+            for key in self:
+                if next(automaton.iter(key), None) is not None:
+                    keys.append(key)
+            return keys
+
         for key in self:
             for name in names:
                 if key.find(name) != -1:
@@ -556,6 +778,51 @@ class Store():
                     break
         return keys
 
+    def _iter_matches(self, term):
+        """Search through all keys line by line.
+
+        :param str term: The regular expression to search for.
+
+        :rtype: generator
+        :returns: A generator yielding a tuple of the key, the line the
+            term was found on and the match object for every matching
+            line in the store.
+
+        """
+        regex = _compile(term, re.MULTILINE)
+        line_by_line = _CONTEXT_TERM.search(term) is not None
+        keys = list(self)
+        # Decrypting is by far the slowest part, so we decrypt the
+        # keys in parallel.  As map returns the keys in order, the
+        # results are still sorted like the keys in the store.
+        with ThreadPoolExecutor(max_workers=self.gpg_workers) as executor:
+            key_data = executor.map(self.get_key, keys)
+            for key, data in zip(keys, key_data):
+                if line_by_line:
+                    for line in data.split('\n'):
+                        match = regex.search(line)
+                        if match is not None:
+                            yield key, line, match
+                    continue
+
+                # Only lines with a match in the whole key are split
+                # off and searched on their own, to get the same match
+                # objects as when searching line by line.
+                pos = 0
+                while pos <= len(data):
+                    match = regex.search(data, pos)
+                    if match is None:
+                        break
+                    start = data.rfind('\n', 0, match.start()) + 1
+                    end = data.find('\n', match.start())
+                    if end == -1:
+                        end = len(data)
+                    line = data[start:end]
+                    match = regex.search(line)
+                    if match is not None:
+                        yield key, line, match
+                    pos = end + 1
+
     @initialised
     def search(self, term):
         """Search through all keys.
@@ -573,16 +840,31 @@ class Store():
         if term is None:
             return {}
 
-        regex = re.compile(term)
-        results = {}
-        for key in self:
-            data = self.get_key(key)
-            for line in data.split('\n'):
-                match = regex.search(line)
-                if match is not None:
-                    if key in results:
-                        results[key].append((line, match))
-                    else:
-                        results[key] = [(line, match)]
-
-        return results
+        results = defaultdict(list)
+        for key, line, match in self._iter_matches(term):
+            results[key].append((line, match))
+        return dict(results)
+
+    @initialised
+    def search_lines(self, term):
+        """Search through all keys and only return the matching lines.
+
+        Works like :meth:`passpy.store.Store.search`, but does not keep
+        the match objects around.
+
+        :param str term: The term to search for.  The term will be
+            compiled as a regular expression.
+
+        :rtype: dict
+        :returns: The dictionary has an entry for each key, that
+            matched the given term.  The entry for that key then
+            contains a list of the lines the term was found on.
+
+        """
+        if term is None:
+            return {}
+
+        results = defaultdict(list)
+        for key, line, _ in self._iter_matches(term):
+            results[key].append(line)
+        return dict(results)
@@ -15,7 +15,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import random
 import shutil
 import string
 
@@ -27,6 +26,11 @@ from passpy.exceptions import (
 )
 
 
+# The characters passwords are generated from.
+_CHARS = (string.ascii_letters + string.digits).encode('ascii')
+_CHARS_SYMBOLS = _CHARS + string.punctuation.encode('ascii')
+
+
 def trap(path_index):
     """Prevent accessing files and directories outside the password store.
 
@@ -96,8 +100,10 @@ def initialised(func):
 def gen_password(length, symbols=True):
     """Generates a random string.
 
-    Uses :class:`random.SystemRandom` if available and
-    :class:`random.Random` otherwise.
+    The random bytes are read from :func:`os.urandom` at once and
+    mapped onto the allowed characters.  Bytes that would favour some
+    characters over others are discarded, so every character is
+    equally likely.
 
     :param int length: The length of the random string.
 
@@ -109,16 +115,19 @@ def gen_password(length, symbols=True):
     :returns: A random string of length `length`.
 
     """
-    try:
-        rand = random.SystemRandom()
-    except NotImplementedError:
-        rand = random.Random()
-
-    chars = string.ascii_letters + string.digits
-    if symbols:
-        chars += string.punctuation
-
-    return ''.join(rand.choice(chars) for _ in range(length))
+    chars = _CHARS_SYMBOLS if symbols else _CHARS
+    num_chars = len(chars)
+    limit = 256 - 256 % num_chars
+
+    password = bytearray()
+    while len(password) < length:
+        # Read twice as many bytes as needed, so that usually a single
+        # read suffices even after discarding some bytes.
+        missing = length - len(password)
+        password.extend(chars[byte % num_chars]
+                        for byte in os.urandom(2 * missing)
+                        if byte < limit)
+    return password[:length].decode('ascii')
 
 
 def copy_move(src, dst, force=False, move=False, interactive=False,
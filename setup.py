@@ -26,6 +26,7 @@ setup(
     ],
     extras_require = {
         'color': ['colorama'],
+        'find': ['pyahocorasick'],
     },
     classifiers=[
         'Development Status :: 5 - Production/Stable',